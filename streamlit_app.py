@@ -1,8 +1,17 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import requests
+import json
+import io
+import orjson
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+from requests.adapters import HTTPAdapter
 import time
+import logging
 import plotly.express as px
+from streamlit_autorefresh import st_autorefresh
 
 # ---------------------------------------------------------
 # PAGE CONFIG
@@ -20,118 +29,348 @@ start_button = st.button("🚀 Start Live Dashboard", use_container_width=True,
 # ---------------------------------------------------------
 # USER INPUTS
 # ---------------------------------------------------------
-api_token = "4fefa33dcfbd11038b91e03c4da752db845fb790"
+try:
+    default_token = st.secrets.get("KOBO_TOKEN", "")
+except FileNotFoundError:  # no secrets.toml configured
+    default_token = ""
+
+# The secret stays on the server; the field is only an optional override
+api_token = st.text_input(
+    "🔑 KoboToolbox API Token",
+    type="password",
+    placeholder="Using the configured token" if default_token else "",
+) or default_token
 form_id = "aF3hzEPTJkYZqMQk37NCpd"
 
 refresh_rate = st.slider("⏱ Auto-Refresh (seconds)", 10, 300, 30)
 st.write(f"Dashboard will automatically update every {refresh_rate} seconds.")
+force_refresh = st.button("🔁 Force Refresh", use_container_width=True, key="force_refresh")
 
 placeholder = st.empty()  # placeholder for live refresh UI
 
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = 1000  # submissions per API page
+MAX_BAR_CATEGORIES = 30  # bars drawn in the distribution chart
+CACHE_ENTRIES = 32  # results kept per cached analytics helper (shared by all sessions)
+
 # ---------------------------------------------------------
 # FUNCTION TO FETCH DATA
 # ---------------------------------------------------------
-def get_kobo_data(api_token, form_id):
+# One pooled session shared across reruns so refreshes reuse the
+# keep-alive connection instead of doing a new TCP/TLS handshake.
+@st.cache_resource
+def get_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+    session.mount("https://", adapter)
+    return session
+
+
+# Cached per (token, form, cutoff, refresh window): reruns inside the same
+# window reuse the normalized DataFrame instead of downloading it again.
+@st.cache_data(ttl=refresh_rate, show_spinner=False)
+def get_kobo_data(api_token, form_id, since=None, refresh_bucket=None):
     url = f"https://kf.kobotoolbox.org/api/v2/assets/{form_id}/data/"
 
     headers = {
         "Authorization": f"Token {api_token}"
     }
 
-    response = requests.get(url, headers=headers)
+    # Only ask for submissions from the last seen second onwards; the bound is
+    # inclusive because _submission_time has one-second resolution
+    params = {"limit": PAGE_SIZE}
+    if since:
+        params["query"] = json.dumps({"_submission_time": {"$gte": since}})
 
-    print("STATUS:", response.status_code)
-    print("RAW:", response.text[:500])  # DEBUG
+    # Normalize page by page so only one page of raw dicts is alive at a time
+    pages = []
+    while url:
+        response = get_session().get(url, headers=headers, params=params, timeout=10)
 
-    if response.status_code != 200:
-        raise Exception(f"Error fetching data: {response.status_code}")
+        logger.debug("Kobo %s -> %s: %r", url, response.status_code, response.content[:500])
 
-    try:
-        data = response.json()
-    except Exception as e:
-        print("JSON ERROR:", e)
-        print("Full response:", response.text)
-        raise e
+        # Bad token: let the caller stop retrying instead of raising
+        if response.status_code in (401, 403):
+            return None
+
+        if response.status_code != 200:
+            raise Exception(f"Error fetching data: {response.status_code}")
+
+        try:
+            data = orjson.loads(response.content)
+        except orjson.JSONDecodeError:
+            logger.debug("Undecodable Kobo response: %r", response.content[:500])
+            raise
+
+        pages.append(pd.json_normalize(data.get("results", [])))
+
+        # "next" already carries the query string
+        url = data.get("next")
+        params = None
+
+    df = pd.concat(pages, ignore_index=True) if len(pages) > 1 else pages[0]
 
-    df = pd.json_normalize(data.get("results", []))
+    # Arrow-backed columns let st.dataframe / the CSV writer hand buffers
+    # straight to Arrow instead of converting Python objects
+    df = df.convert_dtypes(dtype_backend="pyarrow")
     return df
 
+
+def refresh_bucket(refresh_rate):
+    return int(time.time() // refresh_rate)
+
+
+# Choice questions come back as repeated strings; storing them as
+# categories lets isin / value_counts / unique work on integer codes.
+# Low-cardinality columns are categorical, the rest stay Arrow strings; this
+# is decided once on the full load and kept by append_rows afterwards.
+def to_categories(df):
+    for col in df.columns:
+        if col == "_submission_time" or not pd.api.types.is_string_dtype(df[col]):
+            continue
+        try:
+            n_unique = df[col].nunique(dropna=True)
+        except (TypeError, NotImplementedError):  # list/dict cells (repeat groups, attachments)
+            continue
+        if n_unique < max(50, 0.5 * len(df)):
+            df[col] = df[col].astype("category")
+    return df
+
+
+# Concatenating a categorical with strings falls back to object, so new
+# values are added to the existing categories before appending.
+def append_rows(df, new_df):
+    casts = {}
+    for col in df.columns:
+        if not isinstance(df[col].dtype, pd.CategoricalDtype) or col not in new_df.columns:
+            continue
+        new_cats = pd.Index(new_df[col].dropna().unique()).difference(df[col].cat.categories)
+        if len(new_cats):
+            df[col] = df[col].cat.add_categories(new_cats)
+        casts[col] = new_df[col].astype(df[col].dtype)
+    return pd.concat([df, new_df.assign(**casts)], ignore_index=True)
+
+
+# Keeps the submissions seen so far in session state and appends only the
+# ones not seen yet (by _id) since the last _submission_time on each refresh.
+def load_kobo_data(api_token, form_id):
+    key = (api_token, form_id)
+    state = st.session_state.get("kobo_cache")
+
+    if state is None or state["key"] != key:
+        state = {"key": key, "df": pd.DataFrame(), "last_ts": None}
+
+    # Don't hit the API every tick with credentials it already rejected
+    if st.session_state.get("auth_failed") == key:
+        return None
+
+    new_df = get_kobo_data(api_token, form_id, state["last_ts"], refresh_bucket(refresh_rate))
+    if new_df is None:
+        st.session_state["auth_failed"] = key
+        return None
+
+    # The inclusive cutoff re-sends the newest rows we already have
+    if state["last_ts"] is not None and "_id" in new_df.columns and "_id" in state["df"].columns:
+        new_df = new_df[~new_df["_id"].isin(state["df"]["_id"])]
+
+    if not new_df.empty:
+        if state["last_ts"] is None:
+            # No cutoff was sent, so this is the full result: replace, don't append
+            df = to_categories(new_df)
+        else:
+            df = append_rows(state["df"], new_df)
+        state["df"] = df
+        if "_submission_time" in df.columns:
+            state["last_ts"] = df["_submission_time"].max()
+
+    st.session_state["kobo_cache"] = state
+    return state["df"]
+
+
+# ---------------------------------------------------------
+# CACHED ANALYTICS HELPERS
+# ---------------------------------------------------------
+# Hashing every cell of a big frame on each call would cost as much as the
+# work being cached, so frames are keyed on shape, row labels and newest
+# _submission_time. Edits to existing submissions (e.g. validation status)
+# don't change that key; Force Refresh clears these caches to pick them up.
+def df_fingerprint(df):
+    max_ts = df["_submission_time"].max() if "_submission_time" in df.columns else None
+    index_hash = int(pd.util.hash_pandas_object(df.index).sum())
+    return (df.shape, tuple(df.columns), index_hash, max_ts)
+
+
+DF_HASH = {pd.DataFrame: df_fingerprint}
+
+
+@st.cache_data(show_spinner=False, hash_funcs=DF_HASH, max_entries=CACHE_ENTRIES)
+def column_values(df, col):
+    return df[col].dropna().unique()
+
+
+# selections is a tuple of (column, values) pairs; all masks are combined
+# first so the frame is sliced once instead of once per column. Not cached:
+# a cache hit unpickles a full copy of the frame, which costs far more than
+# the isin masks themselves.
+def filter_data(df, selections):
+    masks = [df[col].isin(vals).to_numpy() for col, vals in selections if vals]
+    if not masks:
+        return df
+    return df[np.logical_and.reduce(masks)]
+
+
+@st.cache_data(show_spinner=False, hash_funcs=DF_HASH, max_entries=CACHE_ENTRIES)
+def count_values(df, col):
+    counts = df[col].value_counts()
+    counts = counts[counts > 0]  # categoricals also report unused categories
+    return counts.rename_axis(col).reset_index(name="Count")
+
+
+def is_nested(col):
+    if isinstance(col.dtype, pd.ArrowDtype):
+        return pa.types.is_nested(col.dtype.pyarrow_dtype)
+    return col.dtype == object
+
+
+def to_json_cell(value):
+    if isinstance(value, (list, dict)):
+        return orjson.dumps(value, default=str).decode("utf-8")
+    return value
+
+
+# Arrow's C++ CSV writer is much faster than DataFrame.to_csv but rejects
+# list/struct columns, and every Kobo result has some (_geolocation, _tags,
+# _attachments, _notes); those are written as JSON strings instead.
+@st.cache_data(show_spinner=False, hash_funcs=DF_HASH, max_entries=4)
+def to_csv_bytes(df):
+    nested = [col for col in df.columns if is_nested(df[col])]
+    if nested:
+        # Iterating (not .map) gives plain lists/dicts for Arrow list columns too
+        df = df.assign(**{col: [to_json_cell(v) for v in df[col]] for col in nested})
+    try:
+        buf = io.BytesIO()
+        pa_csv.write_csv(pa.Table.from_pandas(df, preserve_index=False), buf)
+        return buf.getvalue()
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError, pa.ArrowTypeError):
+        return df.to_csv(index=False).encode("utf-8")
+
+
+# Keeps the n largest categories and folds the rest into one "Other" bar.
+def top_counts(counts, col, n=MAX_BAR_CATEGORIES):
+    if len(counts) <= n:
+        return counts
+    other = pd.DataFrame({col: ["Other"], "Count": [counts["Count"].iloc[n:].sum()]})
+    return pd.concat([counts.head(n), other], ignore_index=True)
+
+
+if force_refresh:
+    get_kobo_data.clear()
+    column_values.clear()
+    count_values.clear()
+    to_csv_bytes.clear()
+    st.session_state.pop("kobo_cache", None)
+    st.session_state.pop("auth_failed", None)
+    for chart_key in ("chart_sig", "chart_fig", "chart_fig_col"):
+        st.session_state.pop(chart_key, None)
+
 # ---------------------------------------------------------
-# LIVE AUTO-UPDATE LOOP
+# LIVE AUTO-UPDATE
 # ---------------------------------------------------------
-if api_token and form_id and start_button:
-
-    while True:
-        with placeholder.container():
-
-            st.info("🔄 Fetching latest data from KoboToolbox...")
-
-            df = get_kobo_data(api_token, form_id)
-
-            if df is None:
-                st.error("❌ Failed to fetch data. Check token or form ID.")
-                break
-            if df.empty:
-                st.info("No submissions found for this form.")
-                st.stop()
-
-            # --------------------------------------------
-            # METRICS
-            # --------------------------------------------
-            st.subheader("📌 Summary Metrics")
-
-            col1, col2, col3 = st.columns(3)
-
-            col1.metric("Total Submissions", len(df))
-            col2.metric("Columns Available", df.shape[1])
-            col3.metric("Last Update", pd.Timestamp.now().strftime("%H:%M:%S"))
-
-            # --------------------------------------------
-            # FILTERS
-            # --------------------------------------------
-            st.subheader("🔍 Data Filters")
-
-            column_filter = st.selectbox("Choose column to filter:", df.columns, key=f"filter_col_{len(df.columns)}")
-            unique_vals = df[column_filter].dropna().unique()
-
-            selected_filter = st.multiselect(
-                "Select values to include:", unique_vals
-            )
-
-            filtered_df = df
-            if selected_filter:
-                filtered_df = df[df[column_filter].isin(selected_filter)]
-
-            # --------------------------------------------
-            # DATA TABLE
-            # --------------------------------------------
-            st.subheader("📄 Live Data Table")
-            st.dataframe(filtered_df, height=350)
-
-            # --------------------------------------------
-            # INTERACTIVE CHARTS (Plotly)
-            # --------------------------------------------
-            st.subheader("📈 Interactive Visualization")
-
-            selected_chart_col = st.selectbox("Choose a column to visualize:", df.columns, key=f"filter_col_{len(df.columns)+1}")
-
-            try:
-                fig = px.bar(
-                    filtered_df[selected_chart_col].value_counts(),
-                    title=f"Distribution of {selected_chart_col}",
-                )
-                st.plotly_chart(fig, use_container_width=True)
-            except:
-                st.warning("⚠ Cannot plot this column.")
-
-            # --------------------------------------------
-            # DOWNLOAD SECTION
-            # --------------------------------------------
-            st.subheader("⬇ Download Data")
-
-            # CSV
-            csv = filtered_df.to_csv(index=False).encode("utf-8")
-            st.download_button("Download CSV", data=csv, file_name="kobo_data.csv", use_container_width=True, key="csv_down")
-
-            
-        time.sleep(refresh_rate)
+if start_button:
+    st.session_state["live"] = True
+
+if api_token and form_id and st.session_state.get("live"):
+
+    # Rerun the script every refresh_rate seconds instead of looping forever
+    st_autorefresh(interval=refresh_rate * 1000, key="tick")
+
+    with placeholder.container():
+
+        st.info("🔄 Fetching latest data from KoboToolbox...")
+
+        df = load_kobo_data(api_token, form_id)
+
+        if df is None:
+            st.error("❌ Failed to fetch data. Check token or form ID.")
+            st.stop()
+        if df.empty:
+            st.info("No submissions found for this form.")
+            st.stop()
+
+        # --------------------------------------------
+        # METRICS
+        # --------------------------------------------
+        st.subheader("📌 Summary Metrics")
+
+        col1, col2, col3 = st.columns(3)
+
+        col1.metric("Total Submissions", len(df))
+        col2.metric("Columns Available", df.shape[1])
+        col3.metric("Last Update", pd.Timestamp.now().strftime("%H:%M:%S"))
+
+        # --------------------------------------------
+        # FILTERS
+        # --------------------------------------------
+        st.subheader("🔍 Data Filters")
+
+        column_filter = st.selectbox("Choose column to filter:", df.columns, key="filter_col")
+        unique_vals = column_values(df, column_filter)
+
+        selected_filter = st.multiselect(
+            "Select values to include:", unique_vals
+        )
+
+        filtered_df = filter_data(df, ((column_filter, tuple(selected_filter)),))
+
+        # --------------------------------------------
+        # DATA TABLE
+        # --------------------------------------------
+        st.subheader("📄 Live Data Table")
+        st.dataframe(filtered_df, height=350)
+
+        # --------------------------------------------
+        # INTERACTIVE CHARTS (Plotly)
+        # --------------------------------------------
+        st.subheader("📈 Interactive Visualization")
+
+        selected_chart_col = st.selectbox("Choose a column to visualize:", df.columns, key="chart_col")
+        chart_ph = st.empty()  # fixed slot so the chart is updated in place
+
+        try:
+            # Streamlit drops any element a rerun doesn't emit, so the chart is
+            # always drawn; only the counting and figure update are skipped
+            # when the filtered data and chart column are unchanged.
+            chart_sig = (df_fingerprint(filtered_df), selected_chart_col)
+            fig = st.session_state.get("chart_fig")
+
+            if fig is None or st.session_state.get("chart_sig") != chart_sig:
+                # Cap the number of bars so the chart DOM stays small
+                chart_data = top_counts(count_values(filtered_df, selected_chart_col), selected_chart_col)
+
+                # Build the figure once per column; later ticks only swap the bar data
+                if fig is None or st.session_state.get("chart_fig_col") != selected_chart_col:
+                    fig = px.bar(
+                        chart_data,
+                        x=selected_chart_col,
+                        y="Count",
+                        title=f"Distribution of {selected_chart_col}",
+                    )
+                    st.session_state["chart_fig"] = fig
+                    st.session_state["chart_fig_col"] = selected_chart_col
+                else:
+                    fig.update_traces(x=chart_data[selected_chart_col].tolist(), y=chart_data["Count"].tolist())
+
+                st.session_state["chart_sig"] = chart_sig
+
+            chart_ph.plotly_chart(fig, use_container_width=True, key="dist_chart")
+        except:
+            chart_ph.warning("⚠ Cannot plot this column.")
+
+        # --------------------------------------------
+        # DOWNLOAD SECTION
+        # --------------------------------------------
+        st.subheader("⬇ Download Data")
+
+        # CSV, built only when the button is clicked
+        st.download_button("Download CSV", data=lambda: to_csv_bytes(filtered_df), file_name="kobo_data.csv", use_container_width=True, key="csv_down")